@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import asyncio
 from datetime import timedelta
@@ -10,6 +11,13 @@ from pathlib import Path
 import math
 from utils import *
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from reoptimize import RouteCache, reoptimize_results, route_length
+from granular import DEFAULT_K, candidate_lists, is_complete, widen
+from deadline import Deadline
+
+POST_OPTIMIZE = True    # Re-sequence the routes of every solution before writing it
+
 def solve(model_name, solver_name, data_file):
     """Solve the minizinc model given a selected solver, data file (.dzn) and write results
     to an output_file
@@ -21,26 +29,29 @@ def solve(model_name, solver_name, data_file):
         output_file (str): name of the file to write the solution
     """
 
+    # The time budget (300 s) covers loading the model and data, solving and gathering the results
+    deadline = Deadline(300)
+
     model = Model(f"CP/src/{model_name}.mzn")   # Load model from the file
     solver = Solver.lookup(solver_name)              # Look for the configuration of gecode solver
     
     instance = Instance(solver, model)          # Create instance of the problem
     instance.add_file(data_file)                # Add the data to the instance
 
-    # Solve instance (set a timeout of 300000 miliseconds)
-    timeout = timedelta(milliseconds=300000)
-    result = instance.solve(timeout=timeout)
+    # Solve instance with the time left
+    result = instance.solve(timeout=timedelta(seconds=deadline.remaining()))
 
     # Default values established in case a solution is not found
-    time_sol = 300000       # Time is set by default to maximum
+    time_sol = deadline.budget       # Time is set by default to maximum
     optimal_sol = False
     obj_sol = None
     solution = []
 
     # If the solution is found, change values
     if result.solution:
-        time_sol = math.floor(int(result.statistics.get('time').total_seconds()))
-        if time_sol < 300: optimal_sol = True
+        # Optimal only if the solver proved it
+        optimal_sol = result.status == Status.OPTIMAL_SOLUTION
+        if optimal_sol: time_sol = math.floor(deadline.elapsed())
         obj_sol = int(result.objective)
 
         # Remove the repeated values from the solution (the repeated value is n+1 indicating the courier coming back to origin)
@@ -60,6 +71,137 @@ def solve(model_name, solver_name, data_file):
     # Return the json data
     return data
 
+def set_parameters(instance, parameters):
+    """Add the data of an instance given in memory (instead of a .dzn file) to a minizinc instance
+
+    Args:
+        instance (minizinc.Instance): instance of the problem
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+    """
+    m, n, l, s, D = parameters
+    instance["m"] = m
+    instance["n"] = n
+    instance["l"] = l
+    instance["s"] = s
+    instance["D"] = D
+
+def result_to_dict(result, deadline):
+    """Results (time, optimal, obj, sol) of a minizinc result solved within the given deadline
+
+    Args:
+        result (minizinc.Result): result of the solver (with or without intermediate solutions)
+        deadline (Deadline): global time budget of the instance
+
+    Returns:
+        dict: results of the computation
+    """
+
+    results = {"time": deadline.budget, "optimal": False, "obj": None, "sol": []}
+    if result.solution:
+        last_result = result.solution[-1] if isinstance(result.solution, list) else result.solution
+        results["optimal"] = result.status == Status.OPTIMAL_SOLUTION and getattr(result, 'complete', True)
+        if results["optimal"]: results["time"] = math.floor(deadline.elapsed())
+        results["obj"] = int(result.objective)
+        # Remove the repeated values from the solution (the repeated value is n+1 indicating the courier coming back to origin)
+        results["sol"] = [[item for item in c if c.count(item) == 1] for c in last_result.routes]
+
+    return results
+
+def build_incremental_instance(solver_name, parameters, model_name="MCP"):
+    """Create an instance with all the data except the courier loads. It can be kept alive and solved
+    again (see solve_incremental) each time only the capacities change, without reloading the model.
+
+    Args:
+        solver_name (str): choosen solver to solve the instance
+        parameters (tuple): parameters of the instance (m, n, l, s, D), l is not used
+        model_name (str): name of the model to be use to solve the instance
+
+    Returns:
+        minizinc.Instance: the instance without the loads
+    """
+    m, n, _, s, D = parameters
+    instance = Instance(Solver.lookup(solver_name), Model(f"CP/src/{model_name}.mzn"))
+    instance["m"] = m
+    instance["n"] = n
+    instance["s"] = s
+    instance["D"] = D
+    return instance
+
+def solve_incremental(instance, parameters, initial_routes, deadline):
+    """Incremental re-solve: solve a branch of a live instance with the given loads, bounding the
+    objective with the repaired solution of the previous instance (the search itself is not warm
+    started, the model already fixes its search annotation). If the solver does not improve on it in
+    time, the repaired solution itself is returned (not optimal).
+
+    Args:
+        instance (minizinc.Instance): instance built by build_incremental_instance
+        parameters (tuple): parameters of the new instance (m, n, l, s, D)
+        initial_routes (list): repaired routes (0-based items)
+        deadline (Deadline): global time budget
+
+    Returns:
+        dict: results of the computation
+    """
+
+    _, n, l, _, D = parameters
+    obj = max([route_length(route, D, n) for route in initial_routes])
+
+    with instance.branch() as child:
+        child["l"] = l
+        # Never worse than the repaired solution
+        child.add_string(f"constraint max(dist_courier) <= {obj};")
+        result = child.solve(timeout=timedelta(seconds=deadline.remaining()))
+
+    results = result_to_dict(result, deadline)
+    if results["obj"] is None or obj < results["obj"]:
+        results.update({"optimal": False, "time": deadline.budget, "obj": obj,
+                        "sol": [[i+1 for i in route] for route in initial_routes]})
+
+    return results
+
+async def solve_granular(solver_name, data_file, k=DEFAULT_K, timeout=timedelta(minutes=5), parameters=None, deadline=None):
+    """Solve the MCPGranular model, where each item can only be followed by its k nearest neighbours.
+    If the restricted model gives no solution within half of the remaining time, k is doubled and the
+    model solved again, until the candidate graph is complete.
+
+    Args:
+        solver_name (str): choosen solver to solve the instance
+        data_file (str): data file (.dzn) containing the instance of the problem
+        k (int): number of nearest neighbours of each item in the first attempt
+        timeout (timedelta): time budget (if no deadline is given)
+        parameters (tuple): parameters of the instance (m, n, l, s, D), used instead of data_file if given
+        deadline (Deadline): global time budget of the instance
+
+    Returns:
+        minizinc.Result: result of the last attempt, with the attribute complete telling if the whole
+        graph was used (otherwise the solution cannot be proven optimal)
+    """
+
+    if parameters is None: D_values = parse_dzn(Path(f"CP/data/{data_file}"))['D']
+    else: D_values = parameters[4]
+    n = len(D_values) - 1
+
+    if deadline is None: deadline = Deadline(timeout.total_seconds())
+
+    while True:
+        candidates = candidate_lists(D_values, k)
+        complete = is_complete(candidates)
+
+        instance = Instance(Solver.lookup(solver_name), Model("CP/src/MCPGranular.mzn"))
+        if parameters is None: instance.add_file(f"CP/data/{data_file}")
+        else: set_parameters(instance, parameters)
+        # Successors are 1-based and the origin (n+1) can always follow
+        instance["cand"] = [{j+1 for j in successors} | {n+1} for successors in candidates]
+
+        budget = deadline.remaining() if complete else deadline.sub(0.5).remaining()
+        result = await instance.solve_async(intermediate_solutions=True, timeout=timedelta(seconds=budget))
+
+        if result.solution or complete or deadline.expired(): break
+        k = widen(k, n)
+
+    result.complete = complete
+    return result
+
 async def solve_instances(models, solvers, data_files, output_folder):
 
     tasks = set()
@@ -68,16 +210,25 @@ async def solve_instances(models, solvers, data_files, output_folder):
         for solver_name in solvers:
             for model_name in models:
 
-                # Create an instance for each file-solver-model
-                model = Model(f"CP/src/{model_name}.mzn")   # Load model from the file
-                solver = Solver.lookup(solver_name)         # Look for the configuration of gecode solver
-                
-                instance = Instance(solver, model)          # Create instance of the problem
-                instance.add_file(f"CP/data/{data_file}")   # Add the data to the instance
+                # The time budget of each task covers loading the model and data, solving and gathering
+                deadline = Deadline(300)
 
-                # Create a task for the solving of each instance
-                task = asyncio.create_task(instance.solve_async(intermediate_solutions=True, timeout=timedelta(minutes=5)))
+                if model_name == "MCPGranular":
+                    # Solve on the near neighbours graph (widened if needed)
+                    task = asyncio.create_task(solve_granular(solver_name, data_file, deadline=deadline))
+                else:
+                    # Create an instance for each file-solver-model
+                    model = Model(f"CP/src/{model_name}.mzn")   # Load model from the file
+                    solver = Solver.lookup(solver_name)         # Look for the configuration of gecode solver
+
+                    instance = Instance(solver, model)          # Create instance of the problem
+                    instance.add_file(f"CP/data/{data_file}")   # Add the data to the instance
+
+                    # Create a task for the solving of each instance
+                    task = asyncio.create_task(instance.solve_async(intermediate_solutions=True, timeout=timedelta(seconds=deadline.remaining())))
                 #task = asyncio.create_task(instance.solve_async(timeout=timedelta(minutes=5)))
+                task.deadline = deadline
+                task.add_done_callback(lambda task: setattr(task, 'elapsed', task.deadline.elapsed()))
                 task.solver = solver_name
                 task.model = model_name
                 task.instance = data_file
@@ -90,6 +241,15 @@ async def solve_instances(models, solvers, data_files, output_folder):
 
     dict_order = [f"{model_name}_{solver_name}" for solver_name in solvers_list for model_name in models_list]
 
+    # RE-OPTIMIZE THE ORDER OF EACH ROUTE
+    if POST_OPTIMIZE:
+        cache = RouteCache()
+        for data_file in data_files:
+            D_values = parse_dzn(Path(f"CP/data/{data_file}"))['D']
+            for results in data.get(data_file).values():
+                reoptimize_results(results, D_values, cache)
+        cache.save()
+
     for data_file in data_files:
 
         output_file = f"{output_folder}{data_file[4:6]}.json"
@@ -130,9 +290,9 @@ def gather_results(tasks):
         if len(result)==0: print("No solutions found")
         if result.solution:
             last_result = result[-1]
-            # FOUND SOLUTION => Change values
-            time_sol = math.floor(int(result.statistics.get('time').total_seconds()))
-            if time_sol < 300: optimal_sol = True
+            # FOUND SOLUTION => Change values (optimal only if the solver proved it on the whole graph)
+            optimal_sol = result.status == Status.OPTIMAL_SOLUTION and getattr(result, 'complete', True)
+            if optimal_sol: time_sol = math.floor(task.elapsed)
             obj_sol = int(result.objective)
 
             # Remove the repeated values from the solution (the repeated value is n+1 indicating the courier coming back to origin)
@@ -159,7 +319,8 @@ if __name__ == '__main__':
     # Define the options for our problem
     models_list = [
         #'MCP',
-        'MCPSymbreakImp'
+        'MCPSymbreakImp',
+        #'MCPGranular'
     ]
 
     solvers_list = [
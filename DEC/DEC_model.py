@@ -0,0 +1,49 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from models import *
+from utils import *
+from datetime import timedelta
+from tqdm import tqdm
+from reoptimize import RouteCache, reoptimize_results
+
+# CONSTANTS
+DEFAULT_TIMEOUT = timedelta(seconds=300)
+DATA_FOLDER = 'test_data/'
+RES_FOLDER = 'res/DEC/'
+POST_OPTIMIZE = True    # Re-sequence the routes of every solution before writing it
+
+if __name__ == "__main__":
+
+    models_list = [
+        "MCPDecomposition"
+    ]
+
+    data_files = os.listdir(DATA_FOLDER)
+    os.makedirs(RES_FOLDER, exist_ok=True)
+    cache = RouteCache()
+
+    for data_file, i in zip(data_files, tqdm(range(len(data_files)))):
+
+        data = {}
+        for model_name in models_list:
+
+            # The time budget covers parsing, solving and gathering the results
+            deadline = Deadline(DEFAULT_TIMEOUT.seconds)
+
+            # READ PARAMETERS
+            parameters = parse_file(f"{DATA_FOLDER}{data_file}")
+
+            # SOLVE THE PROBLEM (assignment, parallel routing and rebalancing)
+            results = solve_decomposition(parameters, deadline=deadline)
+
+            # RE-OPTIMIZE THE ORDER OF EACH ROUTE
+            if POST_OPTIMIZE: reoptimize_results(results, parameters[4], cache)
+            data.update({f"{model_name}": results})
+
+        # WRITE RESULTS
+        write_results(data, f"{RES_FOLDER}{data_file[4:6]}.json")
+
+    cache.save()
@@ -0,0 +1,324 @@
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+from pulp import *
+from utils import *
+from deadline import Deadline
+from reoptimize import route_length
+from cbc import DeadlineCBC
+
+def select_seeds(parameters):
+    """Choose one seed item per courier with a farthest-first criterion: the first seed is the item
+    farthest from the origin point, the next ones are the items farthest from the origin and the seeds
+    already chosen. Couriers with bigger loads get the seeds chosen first.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+
+    Returns:
+        list: seed item (0-based) for each courier
+    """
+
+    m,n,l_values,_,D_values = parameters
+
+    chosen = []
+    for _ in range(min(m, n)):
+        candidates = [i for i in range(n) if i not in chosen]
+        seed = max(candidates, key=lambda i: min([D_values[n][i]] + [D_values[c][i] for c in chosen]))
+        chosen.append(seed)
+
+    seeds = [None] * m
+    for d, seed in zip(sorted(range(m), key=lambda d: -l_values[d]), chosen):
+        seeds[d] = seed
+
+    return seeds
+
+def insertion_costs(parameters, seeds):
+    """Estimate how much assigning each item to each courier lengthens its route, as the cost of
+    inserting the item in the tour origin -> seed -> origin of the courier.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        seeds (list): seed item of each courier
+
+    Returns:
+        list: base length of the tour of each courier
+        list: cost[d][i] of assigning the item i to the courier d
+    """
+
+    m,n,_,_,D_values = parameters
+
+    base = []
+    cost = []
+    for d in range(m):
+        seed = seeds[d]
+        if seed is None:
+            base.append(0)
+            cost.append([D_values[n][i] + D_values[i][n] for i in range(n)])
+            continue
+        base.append(D_values[n][seed] + D_values[seed][n])
+        cost.append([0 if i == seed else
+                     min(D_values[n][i] + D_values[i][seed] - D_values[n][seed],
+                         D_values[seed][i] + D_values[i][n] - D_values[seed][n])
+                     for i in range(n)])
+
+    return base, cost
+
+def build_assignment_model(parameters, seeds, fix_seeds=True):
+    """Build the clustering stage: assign every item to a courier without exceeding its load and
+    minimizing the maximum estimated route length.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        seeds (list): seed item of each courier
+        fix_seeds (bool): force each seed to stay with its courier
+
+    Returns:
+        pulp.LpProblem: the assignment model
+        list: assign variables, assign[d][i] = 1 if the item i is delivered by the courier d
+    """
+
+    m,n,l_values,s_values,_ = parameters
+    model = LpProblem("MCPAssignment", LpMinimize)
+
+    base, cost = insertion_costs(parameters, seeds)
+
+    # DECISION VARIABLES
+    assign = [LpVariable.dicts(f"assign_{d+1}", range(n), cat="Binary") for d in range(m)]
+    maximum = LpVariable("maximum", lowBound=0)
+
+    # DEFINE CONSTRAINTS
+
+    # Every item is delivered by exactly one courier.
+    for i in range(n):
+        model += lpSum([assign[d][i] for d in range(m)]) == 1
+
+    for d in range(m):
+        # Avoid courier overload.
+        model += lpSum([assign[d][i] * s_values[i] for i in range(n)]) <= l_values[d]
+
+        # Each courier delivers at least 1 item (as in the other models).
+        model += lpSum(assign[d].values()) >= 1
+
+        # The seed stays with its courier (if it fits).
+        if fix_seeds and seeds[d] is not None and s_values[seeds[d]] <= l_values[d]:
+            model += assign[d][seeds[d]] == 1
+
+        # Balance estimate of the route length of the courier.
+        model += maximum >= base[d] + lpSum([assign[d][i] * cost[d][i] for i in range(n)])
+
+    # OBJECTIVE FUNCTION
+    model += maximum
+
+    return model, assign
+
+def solve_assignment(parameters, deadline):
+    """Solve the clustering stage.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        deadline (Deadline): time budget of the stage
+
+    Returns:
+        list: items (0-based) assigned to each courier, None if no assignment was found
+    """
+
+    m,n,_,_,_ = parameters
+
+    seeds = select_seeds(parameters)
+    model, assign = build_assignment_model(parameters, seeds)
+    model.solve(DeadlineCBC(deadline, mip=True, msg=False))
+
+    # Pinning the seeds can make the assignment infeasible, use them only in the costs then
+    if model.status != LpStatusOptimal and not deadline.expired():
+        model, assign = build_assignment_model(parameters, seeds, fix_seeds=False)
+        model.solve(DeadlineCBC(deadline, mip=True, msg=False))
+
+    if model.status != LpStatusOptimal: return None
+
+    return [[i for i in range(n) if round(assign[d][i].varValue) == 1] for d in range(m)]
+
+def nearest_neighbour_route(items, D_values, n):
+    route = []
+    left = list(items)
+    current = n
+    while left:
+        current = min(left, key=lambda i: D_values[current][i])
+        left.remove(current)
+        route.append(current)
+    return route
+
+def solve_route(items, D_values, n, timeout):
+    """Routing stage: solve the single courier tour through the given items (MTZ formulation).
+    This function runs in the worker processes, so it must stay at module level.
+
+    Args:
+        items (list): items (0-based) assigned to the courier
+        D_values (list): distance matrix
+        n (int): number of items
+        timeout (float): time limit in seconds, counted from the start of the task
+
+    Returns:
+        list: items in visiting order
+        int: length of the route
+    """
+
+    route = nearest_neighbour_route(items, D_values, n)
+    if len(items) <= 2: return route, route_length(route, D_values, n)
+
+    model = LpProblem("MCPRoute", LpMinimize)
+    nodes = [n] + list(items)
+    k = len(items)
+
+    # DECISION VARIABLES
+    x = {(a, b): LpVariable(f"x_{a}_{b}", cat="Binary") for a in nodes for b in nodes if a != b}
+    u = {a: LpVariable(f"u_{a}", lowBound=1, upBound=k) for a in items}
+
+    # DEFINE CONSTRAINTS
+
+    # Every point is entered and left exactly once.
+    for a in nodes:
+        model += lpSum([x[a, b] for b in nodes if b != a]) == 1
+        model += lpSum([x[b, a] for b in nodes if b != a]) == 1
+
+    # No inner cycles (Miller-Tucker-Zemlin).
+    for a in items:
+        for b in items:
+            if a != b: model += u[a] - u[b] + k * x[a, b] <= k - 1
+
+    # OBJECTIVE FUNCTION
+    model += lpSum([D_values[a][b] * x[a, b] for (a, b) in x])
+
+    # Start from the nearest neighbour route
+    for (a, b), variable in x.items():
+        variable.setInitialValue(0)
+    tour = [n] + route + [n]
+    for a, b in zip(tour[:-1], tour[1:]):
+        x[a, b].setInitialValue(1)
+    for position, a in enumerate(route):
+        u[a].setInitialValue(position + 1)
+
+    model.solve(DeadlineCBC(Deadline(timeout), mip=True, msg=False, warmStart=True))
+
+    if model.status == LpStatusOptimal:
+        successors = {a: b for (a, b), variable in x.items() if round(variable.varValue) == 1}
+        route = []
+        index = successors[n]
+        while index != n:
+            route.append(index)
+            index = successors[index]
+
+    return route, route_length(route, D_values, n)
+
+def best_moves(routes, lengths, parameters):
+    """Candidate moves of one item from the longest route to another courier, sorted by the
+    estimated new length of the worst of the two routes involved.
+
+    Args:
+        routes (list): items of each courier in visiting order
+        lengths (list): length of each route
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+
+    Returns:
+        list: tuples (estimate, item, courier) of the candidate moves
+    """
+
+    m,n,l_values,s_values,D_values = parameters
+
+    longest = lengths.index(max(lengths))
+    tour = [n] + routes[longest] + [n]
+
+    # Every courier keeps at least 1 item
+    if len(routes[longest]) <= 1: return []
+
+    loads = [sum([s_values[i] for i in route]) for route in routes]
+
+    moves = []
+    for p in range(1, len(tour)-1):
+        item = tour[p]
+        saving = D_values[tour[p-1]][item] + D_values[item][tour[p+1]] - D_values[tour[p-1]][tour[p+1]]
+        for d in range(m):
+            if d == longest or loads[d] + s_values[item] > l_values[d]: continue
+            other = [n] + routes[d] + [n]
+            insertion = min([D_values[other[q]][item] + D_values[item][other[q+1]] - D_values[other[q]][other[q+1]]
+                             for q in range(len(other)-1)])
+            moves.append((max(lengths[longest] - saving, lengths[d] + insertion), item, d))
+
+    return sorted(moves)
+
+def solve_decomposition(parameters, timeout=300, workers=None, deadline=None):
+    """Cluster-first, route-second heuristic. The items are assigned to the couriers, every courier
+    tour is solved independently in a process pool, then items of the longest route are moved to
+    other couriers while this reduces the objective. The result is never proven optimal.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        timeout (int): time budget in seconds (if no deadline is given)
+        workers (int): number of worker processes (None to use all the cpus)
+        deadline (Deadline): global time budget of the instance
+
+    Returns:
+        dict: results of the computation
+    """
+
+    m,n,_,_,D_values = parameters
+
+    if deadline is None: deadline = Deadline(timeout)
+    remaining = deadline.remaining
+
+    # Tasks beyond the pool size run in successive batches, each batch gets its share of the budget
+    workers = workers or os.cpu_count() or 1
+    batches = lambda tasks: math.ceil(tasks / workers)
+
+    time_sol = deadline.budget
+    optimal_sol = False
+    obj_sol = None
+    solution = []
+
+    # STAGE 1: CLUSTERING
+    print("Assigning items...")
+    clusters = solve_assignment(parameters, deadline.sub(1/3, minimum=1))
+
+    if clusters is not None:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+
+            # STAGE 2: ROUTING (one tour per courier, in parallel)
+            print("Routing couriers...")
+            budget = remaining() / 3 / batches(m)
+            futures = [pool.submit(solve_route, items, D_values, n, budget) for items in clusters]
+            routes, lengths = map(list, zip(*[future.result() for future in futures]))
+
+            # FEEDBACK: move items away from the longest route while the objective decreases
+            print("Balancing routes...")
+            improved = True
+            while improved and remaining() > 1:
+                improved = False
+                longest = lengths.index(max(lengths))
+                for _, item, d in best_moves(routes, lengths, parameters):
+                    if remaining() <= 1: break
+
+                    source = [i for i in routes[longest] if i != item]
+                    target = routes[d] + [item]
+                    budget = remaining() / 2 / batches(2)
+                    futures = [pool.submit(solve_route, items, D_values, n, budget) for items in (source, target)]
+                    (source, source_length), (target, target_length) = [future.result() for future in futures]
+
+                    new_lengths = list(lengths)
+                    new_lengths[longest], new_lengths[d] = source_length, target_length
+                    if max(new_lengths) < max(lengths):
+                        routes[longest], routes[d] = source, target
+                        lengths = new_lengths
+                        improved = True
+                        break
+
+        obj_sol = max(lengths)
+        solution = [[i+1 for i in route] for route in routes]
+
+    results = {
+        "time": time_sol,
+        "optimal": optimal_sol,
+        "obj": obj_sol,
+        "sol": solution
+    }
+
+    return results
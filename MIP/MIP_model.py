@@ -1,39 +1,65 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
 from pulp import *
 from models import *
 from utils import *
 from pulp.apis import *
 from datetime import timedelta
 from tqdm import tqdm
+from reoptimize import RouteCache, reoptimize_results
+from incremental import initial_solution
 
 # CONSTANTS
 DEFAULT_TIMEOUT = timedelta(seconds=300)
 DATA_FOLDER = 'test_data/'
 RES_FOLDER = 'res/MIP/'
+POST_OPTIMIZE = True    # Re-sequence the routes of every solution before writing it
 
 if __name__ == "__main__":
     
     models_list = [
         "MCP",
-        "MCPSymbreakImp"
+        "MCPSymbreakImp",
+        "MCPLazy",
+        "MCPGranular"
     ]
 
     data_files = os.listdir(DATA_FOLDER)
+    cache = RouteCache()
 
     for data_file, i in zip(data_files, tqdm(range(len(data_files)))):
 
-        # READ PARAMETERS
-        parameters = parse_file(f"{DATA_FOLDER}{data_file}")
-        m,n,_,_,_ = parameters
-
         data = {}
         for model_name in models_list:
 
-            # BUILD MODEL
-            model, routes = build_model(model_name, parameters)
+            # The time budget covers parsing, building, solving and gathering the results
+            deadline = Deadline(DEFAULT_TIMEOUT.seconds)
+
+            # READ PARAMETERS
+            parameters = parse_file(f"{DATA_FOLDER}{data_file}")
 
-            # SOLVE THE PROBLEM
-            results = solve_model(model, routes, parameters)
+            try:
+                if model_name in ("MCPLazy", "MCPGranular"):
+                    # BUILD THE LEAN MODEL AND SOLVE IT ADDING SUBTOUR CUTS ON DEMAND (MCPGranular: ONLY
+                    # THE ARCS BETWEEN NEAR NEIGHBOURS, WIDENED OVER TIME), STARTING FROM A HEURISTIC SOLUTION
+                    results = solve_warm_model(model_name, parameters, initial_solution(parameters), deadline)
+                else:
+                    # BUILD MODEL
+                    model, routes = build_model(model_name, parameters, deadline)
+
+                    # SOLVE THE PROBLEM
+                    results = solve_model(model, routes, parameters, deadline=deadline)
+            except DeadlineExceeded:
+                # The model could not even be built within the time budget
+                results = default_results(deadline)
+
+            # RE-OPTIMIZE THE ORDER OF EACH ROUTE
+            if POST_OPTIMIZE: reoptimize_results(results, parameters[4], cache)
             data.update({f"{model_name}": results})
         
         # WRITE RESULTS
-        write_results(data, f"res/MIP/{data_file[4:6]}.json")
\ No newline at end of file
+        write_results(data, f"res/MIP/{data_file[4:6]}.json")
+
+    cache.save()
@@ -1,8 +1,14 @@
-import time
 import math
 from pulp import *
+from granular import DEFAULT_K, candidate_lists, is_complete, widen
+from deadline import Deadline, DeadlineExceeded
+from reoptimize import route_length
+from cbc import DeadlineCBC
 
-def build_model(model_name, parameters):
+# Fraction of the remaining time given to each round of the lazy subtour elimination
+ROUND_FRACTION = 0.05
+
+def build_model(model_name, parameters, deadline=None):
 
     m,n,l_values,s_values,D_values = parameters
     model = LpProblem(model_name, LpMinimize)
@@ -46,6 +52,9 @@ def build_model(model_name, parameters):
 
     for d in range(m):
 
+        # Stop building if the time budget is over (raises DeadlineExceeded)
+        if deadline is not None: deadline.check()
+
         # Each courier delivers at least 1 item. (IMPLIED CONSTRAINT)
         # Forces to have at least two 1s for each courier.
         model += lpSum(routes[d]) >= 2
@@ -109,6 +118,7 @@ def build_model(model_name, parameters):
         # Couriers cannot go back to a destination point already visited, except if it is the origin point.
         # Example   o -> 1   1 -> is allowed.
         for i in range(n):
+            if deadline is not None: deadline.check()
             for j in range(n):
                 model += lpSum([routes[d][i][j], routes[d][j][i]]) <= 1
 
@@ -126,30 +136,34 @@ def build_model(model_name, parameters):
 
     return model, routes
 
-def solve_model(model, routes, parameters):
+def solve_model(model, routes, parameters, timeout=300, deadline=None):
 
     m,n,_,_,D_values=parameters
 
-    time_sol = 300
+    # The deadline started before parsing and building, the solver only gets the time left
+    if deadline is None: deadline = Deadline(timeout)
+
+    time_sol = deadline.budget
     optimal_sol = False
     obj_sol = None
     solution = []
 
+    if deadline.expired(): return default_results(deadline)
+
     # Create instance of the solver
-    solver = pulp.PULP_CBC_CMD(mip=True, msg=True, timeLimit=300)
+    solver = DeadlineCBC(deadline, mip=True, msg=True)
 
-    # Solve the model (and time it)
+    # Solve the model
     print("Solving model...")
-    s_time = time()
     model.solve(solver)
-    e_time = time()
-    time_sol = math.floor(e_time-s_time)
 
     status = model.status
     print(status)
 
+    # A solution was found (optimal only if CBC proved it, not if it stopped at the time limit)
     if status == LpStatusOptimal:
         obj_sol = model.objective.value()
+        optimal_sol = model.sol_status == LpSolutionOptimal
 
     # GATHER RESULTS
     routes_values = []
@@ -169,7 +183,266 @@ def solve_model(model, routes, parameters):
                 break
     
     solution = routes_values
-    if time_sol < 300: optimal_sol = True
+    if optimal_sol: time_sol = math.floor(deadline.elapsed())
+
+    results = {
+        "time": time_sol,
+        "optimal": optimal_sol,
+        "obj": obj_sol,
+        "sol": solution
+    }
+
+    return results
+
+
+def build_lazy_model(model_name, parameters, candidates=None, deadline=None):
+    """Build the lean assignment/degree model used by the cutting-plane approach. Subtour elimination
+    constraints are not added here, they are generated on demand by solve_lazy_model.
+
+    Args:
+        model_name (str): name of the model
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        candidates (list): allowed successors of every point (granular model), None to allow every arc
+        deadline (Deadline): global time budget, DeadlineExceeded is raised when it expires
+
+    Returns:
+        pulp.LpProblem: the lean model
+        list: routes variables, routes[d][i][j] = 1 if courier d travels from point i to point j
+              (only the arcs j in candidates[i] exist)
+    """
+
+    m,n,l_values,s_values,D_values = parameters
+    model = LpProblem(model_name, LpMinimize)
+
+    # No arcs on the main diagonal. To ensure that is not possible to go from a distribution point to itself.
+    if candidates is None: candidates = [[j for j in range(n+1) if j != i] for i in range(n+1)]
+    predecessors = [[i for i in range(n+1) if j in candidates[i]] for j in range(n+1)]
+
+    # DECISION VARIABLES
+    routes = [{i: {j: LpVariable(f"routes_{d+1}_{i}_{j}", cat="Binary") for j in sorted(candidates[i])}
+               for i in range(n+1)} for d in range(m)]
+
+    # DEFINE CONSTRAINTS
+
+    # Each destination point is entered exactly once and left exactly once, by one courier.
+    for j in range(n):
+        model += lpSum([routes[d][i][j] for d in range(m) for i in predecessors[j]]) == 1
+        model += lpSum([routes[d][j][i] for d in range(m) for i in candidates[j]]) == 1
+
+    for d in range(m):
+
+        if deadline is not None: deadline.check()
+
+        # Each courier starts from and ends to the origin point.
+        model += lpSum([routes[d][n][j] for j in candidates[n]]) == 1
+        model += lpSum([routes[d][i][n] for i in predecessors[n]]) == 1
+
+        # Avoid courier overload.
+        model += lpSum([lpSum(routes[d][i].values()) * s_values[i] for i in range(n)]) <= l_values[d]
+
+        # The path must be coherent => a courier leaves every point it enters.
+        for i in range(n):
+            model += (lpSum(routes[d][i].values())
+                    == lpSum([routes[d][t][i] for t in predecessors[i]]))
+
+    # OBJECTIVE FUNCTION
+    objective = [lpSum([D_values[t][j] * routes[i][t][j] for t in range(n+1) for j in routes[i][t]]) for i in range(m)]
+    maximum = LpVariable("maximum", lowBound=0, cat="Integer")
+
+    for i in range(len(objective)):
+        model += maximum>=objective[i]
+
+    model+= maximum
+
+    return model, routes
+
+def get_successors(routes, n):
+    """Read the successor of every point travelled by a courier from the values of the routes variables.
+
+    Args:
+        routes (dict): routes variables of a single courier
+        n (int): number of items
+
+    Returns:
+        dict: successor of each point visited by the courier
+    """
+    return {i: j for i in range(n+1) for j, variable in routes[i].items()
+            if variable.varValue is not None and round(variable.varValue) == 1}
+
+def find_subtours(successors, n):
+    """Split the arcs of a courier into its main route (the one starting at the origin point) and
+    the inner cycles disconnected from it.
+
+    Args:
+        successors (dict): successor of each point visited by the courier
+        n (int): number of items
+
+    Returns:
+        list: items of the main route in visiting order
+        list: inner cycles, each one as a list of points in visiting order
+    """
+
+    route = []
+    index = successors.get(n, n)
+    while index != n and index not in route:
+        route.append(index)
+        index = successors.get(index, n)
+
+    subtours = []
+    visited = set(route)
+    for start in successors:
+        if start == n or start in visited: continue
+        cycle = []
+        index = start
+        while index not in visited:
+            visited.add(index)
+            cycle.append(index)
+            index = successors[index]
+        subtours.append(cycle)
+
+    return route, subtours
+
+def splice_subtours(route, subtours, D_values, n, allowed=None):
+    """Merge the inner cycles into the main route at their cheapest insertion point. The result is a
+    feasible route for the courier (same items, so same load) used to warm start the next iteration.
+
+    Args:
+        route (list): items of the main route in visiting order
+        subtours (list): inner cycles of the courier
+        D_values (list): distance matrix
+        n (int): number of items
+        allowed (dict): allowed successors of every point, insertions using other arcs come last
+
+    Returns:
+        list: items of the merged route in visiting order
+    """
+
+    route = list(route)
+    for cycle in subtours:
+        tour = [n] + route + [n]
+        best = None
+        # Break arc (u, v) of the route and arc (cycle[k], cycle[k+1]) of the cycle and reconnect them
+        for p in range(len(tour)-1):
+            u, v = tour[p], tour[p+1]
+            for k in range(len(cycle)):
+                a, b = cycle[k], cycle[(k+1) % len(cycle)]
+                delta = D_values[u][b] + D_values[a][v] - D_values[u][v] - D_values[a][b]
+                missing = 0 if allowed is None else (b not in allowed[u]) + (v not in allowed[a])
+                if best is None or (missing, delta) < best[0]: best = ((missing, delta), p, k)
+        _, p, k = best
+        rotated = cycle[k+1:] + cycle[:k+1]
+        route = route[:p] + rotated + route[p:]
+
+    return route
+
+def set_warm_start(model, routes, courier_routes, obj):
+    """Set the initial values of the lazy model variables (MIP start) from the given routes
+
+    Args:
+        model (pulp.LpProblem): lean model built by build_lazy_model
+        routes (list): routes variables of the model
+        courier_routes (list): items (0-based) of each courier in visiting order
+        obj (int): length of the longest route
+    """
+
+    n = len(routes[0]) - 1
+    for d in range(len(routes)):
+        tour = [n] + courier_routes[d] + [n]
+        arcs = set(zip(tour[:-1], tour[1:]))
+        for i in range(n+1):
+            for j, variable in routes[d][i].items():
+                variable.setInitialValue(1 if (i, j) in arcs else 0)
+    for variable in model.variables():
+        if variable.name == "maximum": variable.setInitialValue(obj)
+
+def solve_lazy_model(model, routes, parameters, timeout=300, deadline=None, initial_routes=None):
+    """Solve the lean model by iteratively adding the subtour elimination constraints violated by the
+    incumbent and re-solving (warm started) until no inner cycle remains or the time runs out. Each
+    round gets only a fraction of the remaining time: cutting the subtours of a good incumbent pays
+    off sooner than proving the relaxed model optimal. Once nothing is left to cut (or a round found
+    no solution), the last round gets all the remaining time.
+
+    Args:
+        model (pulp.LpProblem): lean model built by build_lazy_model
+        routes (list): routes variables of the model
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        timeout (int): time budget in seconds for the whole loop (if no deadline is given)
+        deadline (Deadline): global time budget of the instance
+        initial_routes (list): feasible routes (0-based items) used as MIP start of the first solve and
+            returned if no round improves on them
+
+    Returns:
+        dict: results of the computation
+    """
+
+    m,n,_,_,D_values=parameters
+
+    if deadline is None: deadline = Deadline(timeout)
+
+    time_sol = deadline.budget
+    optimal_sol = False
+    obj_sol = None
+    solution = []
+
+    if initial_routes is not None:
+        obj_sol = max([route_length(route, D_values, n) for route in initial_routes])
+        solution = [[index+1 for index in route] for route in initial_routes]
+        set_warm_start(model, routes, initial_routes, obj_sol)
+
+    print("Solving model...")
+    iteration = 0
+    last_round = False
+    while not deadline.expired():
+
+        # CBC is killed if it overruns the round (it does not check its time limit in the root node)
+        round_deadline = deadline if last_round else deadline.sub(ROUND_FRACTION, minimum=1)
+        solver = DeadlineCBC(round_deadline, mip=True, msg=False,
+                             warmStart=iteration > 0 or initial_routes is not None)
+        model.solve(solver)
+        iteration += 1
+
+        # No feasible assignment found (or infeasible instance), try once more with all the time left
+        if model.status != LpStatusOptimal:
+            if last_round: break
+            last_round = True
+            continue
+
+        # CHECK THE INCUMBENT FOR INNER CYCLES
+        courier_routes = []
+        cuts = []
+        for d in range(m):
+            route, subtours = find_subtours(get_successors(routes[d], n), n)
+            cuts += subtours
+            courier_routes.append(splice_subtours(route, subtours, D_values, n, routes[d]))
+
+        # Any incumbent can be turned into a feasible solution by merging its cycles (keep the best one)
+        obj = max([route_length(route, D_values, n) for route in courier_routes])
+        if obj_sol is None or obj < obj_sol:
+            obj_sol = obj
+            solution = [[index+1 for index in route] for route in courier_routes]
+
+        if len(cuts) == 0:
+            # Optimal only if CBC proved the last (subtour free) solution optimal
+            optimal_sol = model.sol_status == LpSolutionOptimal
+            if optimal_sol:
+                time_sol = math.floor(deadline.elapsed())
+                break
+            # Nothing left to cut: give the proof all the remaining time (from the current incumbent)
+            if last_round: break
+            last_round = True
+            continue
+
+        print(f"Iteration {iteration}: adding {len(cuts)} subtour cuts")
+
+        # ADD THE VIOLATED SUBTOUR ELIMINATION CONSTRAINTS (for every courier, the cycle could move)
+        if deadline.expired(): break
+        for cycle in cuts:
+            for d in range(m):
+                model += lpSum([routes[d][i][j] for i in cycle for j in cycle if j in routes[d][i]]) <= len(cycle) - 1
+
+        # WARM START from the merged routes (new cuts, so back to the short rounds)
+        set_warm_start(model, routes, courier_routes, obj)
+        last_round = False
 
     results = {
         "time": time_sol,
@@ -178,4 +451,99 @@ def solve_model(model, routes, parameters):
         "sol": solution
     }
 
-    return results
\ No newline at end of file
+    return results
+
+def solve_granular_model(model_name, parameters, k=DEFAULT_K, timeout=300, deadline=None, initial_routes=None):
+    """Solve the lazy model restricted to the k-nearest-neighbour candidate arcs (plus the arcs of the
+    initial routes, so that they stay a valid MIP start). Each restricted attempt gets half of the
+    remaining time, then k is doubled and the model rebuilt, starting from the best routes found, until
+    the candidate graph is complete or the time runs out. Solutions of a restricted graph are never
+    marked optimal.
+
+    Args:
+        model_name (str): name of the model
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        k (int): number of nearest neighbours of each item in the first attempt
+        timeout (int): time budget in seconds (if no deadline is given)
+        deadline (Deadline): global time budget of the instance
+        initial_routes (list): feasible routes (0-based items) used as MIP start
+
+    Returns:
+        dict: results of the computation
+    """
+
+    _,n,_,_,D_values = parameters
+
+    if deadline is None: deadline = Deadline(timeout)
+
+    results = routes_results(parameters, initial_routes, deadline)
+    complete = False
+    while not complete and not deadline.expired():
+        candidates = candidate_lists(D_values, k)
+        for route in initial_routes or []:
+            tour = [n] + route + [n]
+            for a, b in zip(tour[:-1], tour[1:]): candidates[a].add(b)
+        complete = is_complete(candidates)
+        print(f"Granular model with k = {k}")
+
+        try:
+            model, routes = build_lazy_model(model_name, parameters, candidates, deadline)
+        except DeadlineExceeded:
+            # Keep the best solution of the smaller graphs
+            break
+        attempt = solve_lazy_model(model, routes, parameters, deadline=deadline if complete else deadline.sub(0.5),
+                                   initial_routes=initial_routes)
+
+        if attempt["obj"] is not None and (results["obj"] is None or attempt["obj"] <= results["obj"]):
+            results = attempt
+            initial_routes = [[i-1 for i in route] for route in results["sol"]]
+        k = widen(k, n)
+
+    results["optimal"] = results["optimal"] and complete
+    results["time"] = math.floor(deadline.elapsed()) if results["optimal"] else deadline.budget
+
+    return results
+
+def solve_warm_model(model_name, parameters, initial_routes, deadline):
+    """Solve the lazy (or granular) model starting (CBC MIP start) from feasible routes: the repaired
+    solution of the previous instance for a re-solve, a construction heuristic for a cold solve. If the
+    solver does not improve on them in time, or the model cannot even be built, the routes themselves
+    are returned (not optimal).
+
+    Args:
+        model_name (str): name of the model (MCPLazy or MCPGranular)
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        initial_routes (list): feasible routes (0-based items), None to start without them
+        deadline (Deadline): global time budget
+
+    Returns:
+        dict: results of the computation
+    """
+
+    try:
+        if model_name == "MCPGranular":
+            return solve_granular_model(model_name, parameters, deadline=deadline, initial_routes=initial_routes)
+        model, routes = build_lazy_model(model_name, parameters, deadline=deadline)
+        return solve_lazy_model(model, routes, parameters, deadline=deadline, initial_routes=initial_routes)
+    except DeadlineExceeded:
+        return routes_results(parameters, initial_routes, deadline)
+
+def routes_results(parameters, routes, deadline):
+    """Results of feasible routes not proven optimal (the default results if there are none)"""
+    if routes is None: return default_results(deadline)
+    _,n,_,_,D_values = parameters
+    return {
+        "time": deadline.budget,
+        "optimal": False,
+        "obj": max([route_length(route, D_values, n) for route in routes]),
+        "sol": [[i+1 for i in route] for route in routes]
+    }
+
+def default_results(deadline):
+    """Results reported when no solution is found within the time budget"""
+    return {
+        "time": deadline.budget,
+        "optimal": False,
+        "obj": None,
+        "sol": []
+    }
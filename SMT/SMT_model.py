@@ -1,8 +1,15 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
 from z3 import *
 from utils import *
 from models import *
 import json
 from tqdm import tqdm
+from reoptimize import RouteCache, reoptimize_results
+
+POST_OPTIMIZE = True    # Re-sequence the routes of every solution before writing it
 
 def parse_file(file):
     """Parse a .dat file and create the z3 variables containing the parameters of the problem
@@ -43,27 +50,44 @@ if __name__ == "__main__":
 
     models_list = [
         "MCP",
-        "MCPSymbreakImp"
+        "MCPSymbreakImp",
+        "MCPGranular"
     ]
 
     data_folder = 'test_data/'
     data_files = os.listdir(data_folder)
+    cache = RouteCache()
 
     for data_file, i in zip(data_files, tqdm(range(len(data_files)))):
 
-        # READ PARAMETERS
-        parameters = parse_file(f"{data_folder}/{data_file}")
-        m, n, _, _, _ = parameters
-
         data = {}
         for model_name in models_list:
 
-            # BUILD THE MODEL
-            solver, routes, maximum = build_model(parameters, model_name)
+            # The time budget covers parsing, building, solving and gathering the results
+            deadline = Deadline(300)
+
+            # READ PARAMETERS
+            parameters = parse_file(f"{data_folder}/{data_file}")
 
-            # SOLVE THE MODEL
-            results = solve_model(solver, routes, maximum, parameters, model_name)
+            try:
+                if model_name == "MCPGranular":
+                    # BUILD AND SOLVE THE MODEL ON THE NEAR NEIGHBOURS GRAPH (WIDENED IF NEEDED)
+                    results = solve_granular_model(parameters, model_name, deadline=deadline)
+                else:
+                    # BUILD THE MODEL
+                    solver, routes, maximum = build_model(parameters, model_name, deadline=deadline)
+
+                    # SOLVE THE MODEL
+                    results = solve_model(solver, routes, maximum, parameters, model_name, deadline)
+            except DeadlineExceeded:
+                # The model could not even be built within the time budget
+                results = default_results(deadline, model_name)
+
+            # RE-OPTIMIZE THE ORDER OF EACH ROUTE
+            if POST_OPTIMIZE: reoptimize_results(results.get(model_name), parameters[4], cache)
             update_dict(data, model_name, results.get(model_name))
 
         # WRITE THE RESULTS
-        write_results(data, f"res/SMT/{data_file[4:6]}.json")
\ No newline at end of file
+        write_results(data, f"res/SMT/{data_file[4:6]}.json")
+
+    cache.save()
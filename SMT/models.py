@@ -1,16 +1,20 @@
 from z3 import *
 from utils import *
 from time import time
+from granular import DEFAULT_K, candidate_lists, is_complete, widen
+from deadline import Deadline, DeadlineExceeded
+from reoptimize import route_length
 
-def build_params(parameters, solver):
+def build_params(parameters, solver, deadline=None, loads=True):
     
     # READ PARAMETERS
     m, n, l_values, s_values, D_values = parameters
 
     # TURN PARAMETERS INTO Z3 VARIABLES
     l = Array('l', IntSort(), IntSort())
-    for i in range(m):
-        solver.add(l[i] == l_values[i])
+    if loads:
+        for i in range(m):
+            solver.add(l[i] == l_values[i])
 
     s = Array('s', IntSort(), IntSort())
     for i in range(n):
@@ -19,16 +23,20 @@ def build_params(parameters, solver):
     D = Array('D', IntSort(), ArraySort(IntSort(), IntSort()))  # Distance to each point
     # Set the matrix of distances D to the default values
     for i in range(n+1):
+        if deadline is not None: deadline.check()
     #    #a_i = Array('a_{i}', IntSort(), IntSort())
         for j in range(n+1):
             solver.add(D[i][j] == D_values[i][j])
     
     return solver, l, s, D
 
-def solve_model(solver, routes, maximum, parameters, model_name):
+def solve_model(solver, routes, maximum, parameters, model_name, deadline=None):
+
+    # The deadline started before parsing and building, the solver only gets the time left
+    if deadline is None: deadline = Deadline(300)
 
     # Default values established in case a solution is not found
-    time_sol = 300       # Time is set by default to maximum
+    time_sol = deadline.budget       # Time is set by default to maximum
     optimal_sol = False
     obj_sol = None
     solution = []
@@ -37,30 +45,39 @@ def solve_model(solver, routes, maximum, parameters, model_name):
 
     solver.minimize(maximum)
 
-    print("Checking satisfiability...")
-    s_time = time()
-    result = solver.check()
-    if result == sat:
-        print("Solving...")
-        model = solver.model()
-        length = model.evaluate(maximum)
-        
+    model = None
+    if not deadline.expired():
+        solver.set("timeout", max(1, int(1000 * deadline.remaining())))
+
+        print("Checking satisfiability...")
+        result = solver.check()
+        if result == sat:
+            # The optimizer only answers sat once the optimum is proven
+            print("Solving...")
+            model = solver.model()
+            optimal_sol = True
+        elif result == unknown:
+            # Timeout: keep the best solution found so far (if any), it is not proven optimal
+            print("N/A")
+            try:
+                model = solver.model()
+            except Z3Exception:
+                model = None
+        else:
+            print("Unsat")
+
+    if model is not None:
+        length = model.evaluate(maximum, model_completion=True)
+
         routes_sol = []
         for i in range(m):
-            route = [model.evaluate(routes[i][j]).as_long() for j in range(n+1)]
+            route = [model.evaluate(routes[i][j], model_completion=True).as_long() for j in range(n+1)]
             routes_sol.append([value for value in route if value != n+1])
 
         obj_sol = length.as_long()
         solution = routes_sol
-    elif result == unknown:
-        print("N/A")
-    else:
-        print("Unsat")
-
-    e_time = time()
 
-    time_sol = math.floor(e_time-s_time)
-    if time_sol < 300: optimal_sol = True
+    if optimal_sol: time_sol = math.floor(deadline.elapsed())
 
     results = {
         f"{model_name}":{
@@ -74,32 +91,47 @@ def solve_model(solver, routes, maximum, parameters, model_name):
     return results
 
 
-def build_model(parameters, model_name=None):
+def build_model(parameters, model_name=None, candidates=None, deadline=None, loads=True):
 
-    # CREATE SOLVER INSTANCE
+    # CREATE SOLVER INSTANCE (the timeout is set to the remaining time when solving)
     solver = Optimize()
     solver.set("timeout", 300000)
 
     # BUILD THE PARAMETERS INTO THE MODEL
-    solver, l, s, D = build_params(parameters, solver)
+    solver, l, s, D = build_params(parameters, solver, deadline, loads)
 
     # DEFINE DECISION VARIABLES 
     routes = Array('routes', IntSort(), ArraySort(IntSort(), IntSort()))  # Routes for each courier
 
-    # DEFINE DOMAIN CONSTRAINTS
+    # DEFINE DOMAIN CONSTRAINTS (in the granular model the successor table below bounds the domain)
     m, n, _, _, _ = parameters
-    for i in range(m):
-        for t in range(n):
-            solver.add(And(routes[i][t] >= 1, routes[i][t] <= n + 1))
+    if candidates is None:
+        for i in range(m):
+            for t in range(n):
+                solver.add(And(routes[i][t] >= 1, routes[i][t] <= n + 1))
+    else:
+        # GRANULAR MODEL
+        # Successor table: after item p a courier can only go to the near neighbours of p (or back to the
+        # origin), after the origin it stays there. Any other pair (out of the domain too) is False.
+        successors = K(IntSort(), K(IntSort(), BoolVal(False)))
+        for p in range(1, n+2):
+            row = K(IntSort(), BoolVal(False))
+            for q in (candidates[p-1] if p <= n else [n]):
+                row = Store(row, q+1, BoolVal(True))
+            successors = Store(successors, p, row)
 
     # DEFINE CONSTRAINTS
 
     # All the values from 1 to n need to appear EXACTLY ONCE in the routes matrix
     for p in range(1,n+1):
+        if deadline is not None: deadline.check()
         solver.add(Sum([If(routes[i][j] == p, 1, 0) for i in range(m) for j in range(n+1)]) == 1)
 
     for i in range(m):
-        
+
+        # Stop building if the time budget is over (raises DeadlineExceeded)
+        if deadline is not None: deadline.check()
+
         if model_name == "MCP":
             # The courier must finish at the origin point
             solver.add(routes[i][n] == n+1)
@@ -112,10 +144,15 @@ def build_model(parameters, model_name=None):
         sums = Sum([If(routes[i][j] < n+1, s[routes[i][j] -1], 0) for j in range(n+1)])
         solver.add(sums <= l[i])
 
-        #Constraint to force all the numbers after the first n+1 to be also n+1
-        for j in range(n):
-            solver.add(If(routes[i][j] == n+1, routes[i][j+1] == n+1, True))
-        
+        if candidates is None:
+            #Constraint to force all the numbers after the first n+1 to be also n+1
+            for j in range(n):
+                solver.add(If(routes[i][j] == n+1, routes[i][j+1] == n+1, True))
+        else:
+            # One table lookup per position replaces the domain and the constraint above
+            for j in range(n):
+                solver.add(successors[routes[i][j]][routes[i][j+1]])
+
         if model_name == "MCPSymbreakImp":
             # SYMMETRY BREAKING
             #Constraint to force the first value of each row of the matrix to be different from n+1
@@ -133,4 +170,117 @@ def build_model(parameters, model_name=None):
     dist_courier = [(Sum( [D[routes[i][j]-1][routes[i][j + 1]-1] for j in range(n)] )+ D[n][routes[i][0]-1] )  for i in range(m)]
     maximum = z3_max(dist_courier)
 
-    return solver, routes, maximum
\ No newline at end of file
+    return solver, routes, maximum
+
+def solve_granular_model(parameters, model_name, k=DEFAULT_K, timeout=300, deadline=None):
+    """Solve the MCPSymbreakImp model restricted to the k-nearest-neighbour candidate successors. If
+    the restricted model gives no solution within half of the remaining time, k is doubled and the
+    model rebuilt, until the candidate graph is complete. Solutions of a restricted graph are never
+    marked optimal.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+        model_name (str): name used for the results
+        k (int): number of nearest neighbours of each item in the first attempt
+        timeout (int): time budget in seconds (if no deadline is given)
+        deadline (Deadline): global time budget of the instance
+
+    Returns:
+        dict: results of the computation
+    """
+
+    _,n,_,_,D_values = parameters
+
+    if deadline is None: deadline = Deadline(timeout)
+
+    while True:
+        candidates = candidate_lists(D_values, k)
+        complete = is_complete(candidates)
+        print(f"Granular model with k = {k}")
+
+        solver, routes, maximum = build_model(parameters, "MCPSymbreakImp", candidates, deadline)
+        results = solve_model(solver, routes, maximum, parameters, model_name, deadline if complete else deadline.sub(0.5))
+
+        if results[model_name]["obj"] is not None or complete or deadline.expired(): break
+        k = widen(k, n)
+
+    optimal_sol = results[model_name]["optimal"] and complete
+    results[model_name]["optimal"] = optimal_sol
+    results[model_name]["time"] = math.floor(deadline.elapsed()) if optimal_sol else deadline.budget
+
+    return results
+
+def build_incremental_model(parameters, model_name="MCP", deadline=None):
+    """Build the model without the values of the courier loads, so that the same solver can be kept
+    alive and reused when only the capacities of the instance change.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D), l is not used
+        model_name (str): MCP or MCPSymbreakImp
+        deadline (Deadline): global time budget, DeadlineExceeded is raised when it expires
+
+    Returns:
+        dict: the solver session (solver, routes, maximum and parameters)
+    """
+
+    solver, routes, maximum = build_model(parameters, model_name, deadline=deadline, loads=False)
+    return {"solver": solver, "routes": routes, "maximum": maximum, "parameters": parameters}
+
+def solve_incremental_model(session, l_values, initial_routes, model_name, deadline):
+    """Incremental re-solve: solve a session with the given loads, warm started from the repaired
+    solution of the previous instance (initial values of the routes, when the z3 version supports
+    them) and with the objective bounded by it. Loads and bound live in a push/pop scope, so the
+    session can be solved again for other loads. If the solver does not improve on the repaired
+    solution in time, the repaired solution itself is returned (not optimal).
+
+    Args:
+        session (dict): session built by build_incremental_model
+        l_values (list): load of each courier
+        initial_routes (list): repaired routes (0-based items)
+        model_name (str): name used for the results
+        deadline (Deadline): global time budget
+
+    Returns:
+        dict: results of the computation
+    """
+
+    solver, routes, maximum = session["solver"], session["routes"], session["maximum"]
+    m, n, _, s_values, D_values = session["parameters"]
+    parameters = (m, n, l_values, s_values, D_values)
+
+    obj = max([route_length(route, D_values, n) for route in initial_routes])
+
+    l = Array('l', IntSort(), IntSort())
+    solver.push()
+    # The scope is popped even if the solve fails, the session is reused by the next re-solves
+    try:
+        for i in range(m):
+            solver.add(l[i] == l_values[i])
+        # Never worse than the repaired solution
+        solver.add(maximum <= obj)
+        # Start the search from the repaired solution (padded with the origin point)
+        if hasattr(solver, "set_initial_value"):
+            for i, route in enumerate(initial_routes):
+                padded = [item+1 for item in route] + [n+1] * (n+1 - len(route))
+                for j in range(n+1):
+                    solver.set_initial_value(routes[i][j], padded[j])
+        results = solve_model(solver, routes, maximum, parameters, model_name, deadline)
+    finally:
+        solver.pop()
+
+    if results[model_name]["obj"] is None or obj < results[model_name]["obj"]:
+        results[model_name].update({"optimal": False, "time": deadline.budget, "obj": obj,
+                                    "sol": [[i+1 for i in route] for route in initial_routes]})
+
+    return results
+
+def default_results(deadline, model_name):
+    """Results reported when no solution is found within the time budget"""
+    return {
+        f"{model_name}":{
+            "time": deadline.budget,
+            "optimal": False,
+            "obj": None,
+            "sol": []
+        }
+    }
@@ -0,0 +1,57 @@
+import subprocess
+import threading
+from pulp import PULP_CBC_CMD, PulpSolverError, LpStatusNotSolved
+from pulp.apis import coin_api
+
+# Seconds CBC may run past the deadline before it is killed
+KILL_GRACE = 1
+
+class WatchedSubprocess:
+    """Stand-in for the subprocess module used by pulp to launch CBC: every process it starts is
+    killed by a timer when the deadline (plus KILL_GRACE) expires"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.timers = []
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+    def Popen(self, *args, **kwargs):
+        process = subprocess.Popen(*args, **kwargs)
+        timer = threading.Timer(self.deadline.remaining() + KILL_GRACE, process.kill)
+        timer.daemon = True
+        timer.start()
+        self.timers.append(timer)
+        return process
+
+    def cancel(self):
+        for timer in self.timers: timer.cancel()
+
+class DeadlineCBC(PULP_CBC_CMD):
+    """CBC solver bound to a Deadline. The time limit is the remaining time, and since CBC does not
+    check it during the root processing, the process is killed if it is still running when the
+    deadline expires. A killed solve leaves the problem not solved (model.status == LpStatusNotSolved)
+    and the variables untouched.
+
+    Args:
+        deadline (Deadline): time budget of the solve
+        **kwargs: other arguments of PULP_CBC_CMD (mip, msg, warmStart...)
+    """
+
+    def __init__(self, deadline, **kwargs):
+        super().__init__(timeLimit=deadline.remaining(), **kwargs)
+        self.deadline = deadline
+
+    def actualSolve(self, lp, **kwargs):
+        watched = WatchedSubprocess(self.deadline)
+        coin_api.subprocess = watched
+        try:
+            return super().actualSolve(lp, **kwargs)
+        except PulpSolverError:
+            if not self.deadline.expired(): raise
+            lp.assignStatus(LpStatusNotSolved)
+            return LpStatusNotSolved
+        finally:
+            coin_api.subprocess = subprocess
+            watched.cancel()
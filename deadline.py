@@ -0,0 +1,35 @@
+from time import time
+
+class DeadlineExceeded(Exception):
+    """Raised by Deadline.check when the time budget is over (e.g. while building a model)"""
+
+class Deadline:
+    """Global time budget of the resolution of an instance. It is created before parsing the instance
+    and passed along the whole pipeline: model building checks it to stop cleanly and the solvers get
+    only the time that remains.
+    """
+
+    def __init__(self, budget, end=None):
+        self.start = time()
+        self.budget = budget
+        self.end = self.start + budget if end is None else end
+
+    def remaining(self):
+        return max(0.0, self.end - time())
+
+    def elapsed(self):
+        return time() - self.start
+
+    def expired(self):
+        return time() >= self.end
+
+    def check(self):
+        if self.expired(): raise DeadlineExceeded(f"time budget of {self.budget} s exceeded")
+
+    def sub(self, fraction, minimum=0):
+        """Deadline for a stage that may use only a fraction of the remaining time, but at least minimum
+        seconds if they remain (same start and budget, so the elapsed time is still measured from the
+        beginning of the instance)"""
+        deadline = Deadline(self.budget, min(self.end, time() + max(minimum, fraction * self.remaining())))
+        deadline.start = self.start
+        return deadline
@@ -0,0 +1,43 @@
+import numpy as np
+
+# Number of nearest neighbours kept for each item in the first granular attempt
+DEFAULT_K = 10
+
+def candidate_lists(D_values, k):
+    """Build the sparse candidate graph of the granular models: every item keeps the arcs to its k
+    nearest items (and the reverse ones, so a route can be travelled in both directions), while the
+    arcs from and to the origin point are always kept.
+
+    Args:
+        D_values (list): distance matrix
+        k (int): number of nearest neighbours of each item
+
+    Returns:
+        list: set of allowed successors (0-based, origin = n) of every point
+    """
+
+    D = np.asarray(D_values, dtype=float)
+    n = len(D) - 1
+
+    allowed = np.ones((n+1, n+1), dtype=bool)
+    if k < n - 1:
+        items = D[:n, :n].copy()
+        np.fill_diagonal(items, np.inf)
+        nearest = np.argpartition(items, k-1, axis=1)[:, :k]    # k nearest items of every item
+
+        allowed[:n, :n] = False
+        allowed[np.repeat(np.arange(n), k), nearest.ravel()] = True
+        allowed[:n, :n] |= allowed[:n, :n].T
+
+    np.fill_diagonal(allowed, False)
+
+    return [set(np.flatnonzero(allowed[i]).tolist()) for i in range(n+1)]
+
+def is_complete(candidates):
+    """Check if the candidate graph contains every arc (the granular model is the full model)"""
+    n = len(candidates) - 1
+    return all(len(successors) == n for successors in candidates)
+
+def widen(k, n):
+    """Number of neighbours of the next granular attempt after an infeasible or stalled one"""
+    return min(2 * k, n)
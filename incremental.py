@@ -0,0 +1,146 @@
+import hashlib
+import json
+
+from reoptimize import route_length
+
+def apply_delta(parameters, delta):
+    """Build the instance obtained by applying a small change to a previous one.
+
+    The delta may contain:
+        remove (list): items (1-based) that are no longer delivered
+        add (list): sizes of the new items, numbered after the remaining items
+        D (list): distance matrix of the new instance (needed when items are added)
+        l (dict): new load of some couriers, {courier (1-based): load}
+
+    The remaining items keep their relative order and the origin point stays the last point.
+
+    Args:
+        parameters (tuple): parameters of the previous instance (m, n, l, s, D)
+        delta (dict): change to apply
+
+    Returns:
+        tuple: parameters of the new instance (m, n, l, s, D)
+        list: new index (0-based) of every previous item, None if it was removed
+
+    Raises:
+        ValueError: if the delta is not consistent with the previous instance
+    """
+
+    m, n, l_values, s_values, D_values = parameters
+
+    removed = {i-1 for i in delta.get("remove", [])}
+    if any(i < 0 or i >= n for i in removed): raise ValueError("removed items must be in 1..n")
+
+    kept = [i for i in range(n) if i not in removed]
+    mapping = [None] * n
+    for new_index, i in enumerate(kept): mapping[i] = new_index
+
+    added = list(delta.get("add", []))
+    new_n = len(kept) + len(added)
+    new_s = [s_values[i] for i in kept] + added
+
+    if "D" in delta:
+        new_D = delta["D"]
+        if len(new_D) != new_n+1 or any(len(row) != new_n+1 for row in new_D):
+            raise ValueError("the new distance matrix does not match the new number of items")
+    elif added:
+        raise ValueError("the new distance matrix is needed to add items")
+    else:
+        points = kept + [n]
+        new_D = [[D_values[i][j] for j in points] for i in points]
+
+    new_l = list(l_values)
+    for courier, load in delta.get("l", {}).items():
+        if not 1 <= int(courier) <= m: raise ValueError("couriers must be in 1..m")
+        new_l[int(courier)-1] = load
+
+    return (m, new_n, new_l, new_s, new_D), mapping
+
+def repair_solution(parameters, solution, mapping):
+    """Turn the solution of the previous instance into a feasible solution of the new one: removed
+    items are dropped, items of overloaded couriers are taken out (the ones saving more distance per
+    unit of size first), couriers left without items get one and the other items, together with the
+    new ones, are inserted where they lengthen the longest route the least.
+
+    Args:
+        parameters (tuple): parameters of the new instance (m, n, l, s, D)
+        solution (list): routes of the previous solution (1-based items, as in sol)
+        mapping (list): new index of every previous item, as returned by apply_delta
+
+    Returns:
+        list: repaired routes (0-based items), None if some item does not fit in any courier or some
+            courier cannot get an item
+    """
+
+    m, n, l_values, s_values, D_values = parameters
+
+    routes = [[mapping[i-1] for i in route if mapping[i-1] is not None] for route in solution]
+    routes += [[] for _ in range(m - len(routes))]
+
+    assigned = {i for route in routes for i in route}
+    pending = [i for i in range(n) if i not in assigned]
+
+    # FIX OVERLOADS
+    for d in range(m):
+        while sum([s_values[i] for i in routes[d]]) > l_values[d]:
+            tour = [n] + routes[d] + [n]
+            saving = lambda p: (D_values[tour[p-1]][tour[p]] + D_values[tour[p]][tour[p+1]]
+                                - D_values[tour[p-1]][tour[p+1]]) / max(1, s_values[tour[p]])
+            p = max(range(1, len(tour)-1), key=saving)
+            pending.append(routes[d].pop(p-1))
+
+    # GIVE AN ITEM TO THE EMPTY COURIERS (every courier delivers at least 1 item, as in the models)
+    for d in range(m):
+        if routes[d]: continue
+        # Cheapest round trip among the pending items that fit, otherwise an item of a courier with more than one
+        fitting = [i for i in pending if s_values[i] <= l_values[d]]
+        if fitting:
+            item = min(fitting, key=lambda i: D_values[n][i] + D_values[i][n])
+            pending.remove(item)
+        else:
+            donors = [(i, c) for c in range(m) if len(routes[c]) > 1 for i in routes[c] if s_values[i] <= l_values[d]]
+            if not donors: return None
+            item, c = min(donors, key=lambda donor: D_values[n][donor[0]] + D_values[donor[0]][n])
+            routes[c].remove(item)
+        routes[d].append(item)
+
+    # INSERT THE PENDING ITEMS (biggest first, they are the hardest to place)
+    lengths = [route_length(route, D_values, n) for route in routes]
+    loads = [sum([s_values[i] for i in route]) for route in routes]
+    for item in sorted(pending, key=lambda i: -s_values[i]):
+        best = None
+        for d in range(m):
+            if loads[d] + s_values[item] > l_values[d]: continue
+            tour = [n] + routes[d] + [n]
+            for p in range(len(tour)-1):
+                increase = D_values[tour[p]][item] + D_values[item][tour[p+1]] - D_values[tour[p]][tour[p+1]]
+                key = (lengths[d] + increase, increase)
+                if best is None or key < best[0]: best = (key, d, p)
+
+        if best is None: return None
+
+        (length, _), d, p = best
+        routes[d].insert(p, item)
+        lengths[d] = length
+        loads[d] += s_values[item]
+
+    return routes
+
+def initial_solution(parameters):
+    """Build a feasible solution from scratch, as repair_solution does with an empty previous solution:
+    every courier gets the item with the cheapest round trip that fits, the other items are inserted
+    where they lengthen the longest route the least. Used as the start of the cold solves.
+
+    Args:
+        parameters (tuple): parameters of the instance (m, n, l, s, D)
+
+    Returns:
+        list: routes (0-based items), None if the insertion does not find a feasible solution
+    """
+    return repair_solution(parameters, [], [])
+
+def instance_key(parameters):
+    """Identifier of an instance without the courier loads, used to reuse a live solver when only the
+    capacities change"""
+    m, n, _, s_values, D_values = parameters
+    return hashlib.sha1(json.dumps([m, n, s_values, D_values]).encode()).hexdigest()[:16]
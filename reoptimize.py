@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+# Routes up to this number of items are re-sequenced exactly (Held-Karp), longer ones with local search
+EXACT_LIMIT = 18
+CACHE_FILE = 'res/route_cache.json'
+
+class RouteCache:
+    """Optimal orders of item sets already solved exactly, keyed on the instance distances and the set
+    of items, so the same courier subsets found by different models or runs are not solved twice.
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.routes = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.routes = json.load(file)
+
+    @staticmethod
+    def key(digest, items):
+        return f"{digest}:{','.join(map(str, sorted(items)))}"
+
+    def get(self, digest, items):
+        return self.routes.get(self.key(digest, items))
+
+    def put(self, digest, items, route):
+        self.routes[self.key(digest, items)] = route
+
+    def save(self):
+        if self.path is None: return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as file:
+            json.dump(self.routes, file)
+
+def distances_digest(D_values):
+    return hashlib.sha1(json.dumps(D_values).encode()).hexdigest()[:16]
+
+def route_length(route, D_values, n):
+    """Length of a route starting and ending at the origin point (index n)
+
+    Args:
+        route (list): items of the route in visiting order (0-based)
+        D_values (list): distance matrix
+        n (int): number of items
+
+    Returns:
+        int: total distance travelled
+    """
+    tour = [n] + route + [n]
+    return sum([D_values[tour[k]][tour[k+1]] for k in range(len(tour)-1)])
+
+def held_karp(items, D_values, n):
+    """Optimal order of the items of a route with the Held-Karp dynamic programming over subsets.
+    The transitions of all the subsets of the same size are computed at once with NumPy.
+
+    Args:
+        items (list): items (0-based) of the route
+        D_values (list): distance matrix
+        n (int): number of items (the origin point is the index n)
+
+    Returns:
+        list: items in the optimal visiting order
+    """
+
+    k = len(items)
+    if k <= 1: return list(items)
+
+    D = np.asarray(D_values, dtype=np.int64)
+    points = np.asarray(items)
+    C = D[np.ix_(points, points)]       # Distances between the items of the route
+    start = D[n, points]                # Distances from the origin
+    end = D[points, n]                  # Distances to the origin
+
+    inf = np.iinfo(np.int64).max // 4
+    size = 1 << k
+    dp = np.full((size, k), inf, dtype=np.int64)      # dp[S, j]: shortest path from origin through S ending at j
+    parent = np.full((size, k), -1, dtype=np.int8)
+    dp[1 << np.arange(k), np.arange(k)] = start
+
+    masks = np.arange(size)
+    popcount = np.zeros(size, dtype=np.int64)
+    for j in range(k): popcount += (masks >> j) & 1
+
+    for layer in range(2, k+1):
+        layer_masks = masks[popcount == layer]
+        for j in range(k):
+            sel = layer_masks[(layer_masks >> j) & 1 == 1]
+            cand = dp[sel ^ (1 << j)] + C[:, j]         # Come to j from every possible last item i
+            best = np.argmin(cand, axis=1)
+            dp[sel, j] = cand[np.arange(len(sel)), best]
+            parent[sel, j] = best
+
+    # Close the tour and rebuild it backwards
+    full = size - 1
+    last = int(np.argmin(dp[full] + end))
+    order = []
+    mask = full
+    while last != -1:
+        order.append(last)
+        last, mask = int(parent[mask, last]), mask ^ (1 << last)
+
+    return [items[j] for j in reversed(order)]
+
+def local_search(route, D_values, n):
+    """Improve the order of a route with 2-opt (segment reversal) and Or-opt (move segments of up to
+    three items) until no move shortens it. Distances do not need to be symmetric.
+
+    Args:
+        route (list): items (0-based) of the route in visiting order
+        D_values (list): distance matrix
+        n (int): number of items (the origin point is the index n)
+
+    Returns:
+        list: items in the improved visiting order
+    """
+
+    D = D_values
+    tour = [n] + list(route) + [n]
+    improved = True
+    while improved:
+        improved = False
+
+        # Prefix sums of the tour travelled forwards and backwards (reversal cost in O(1))
+        fwd = [0]
+        bwd = [0]
+        for a, b in zip(tour[:-1], tour[1:]):
+            fwd.append(fwd[-1] + D[a][b])
+            bwd.append(bwd[-1] + D[b][a])
+
+        # 2-OPT: reverse tour[i..j]
+        for i in range(1, len(tour)-2):
+            for j in range(i+1, len(tour)-1):
+                a, b = tour[i-1], tour[j+1]
+                old = D[a][tour[i]] + (fwd[j] - fwd[i]) + D[tour[j]][b]
+                new = D[a][tour[j]] + (bwd[j] - bwd[i]) + D[tour[i]][b]
+                if new < old:
+                    tour[i:j+1] = reversed(tour[i:j+1])
+                    improved = True
+                    break
+            if improved: break
+        if improved: continue
+
+        # OR-OPT: move tour[i..i+length-1] between tour[p] and tour[p+1]
+        for length in range(1, 4):
+            for i in range(1, len(tour)-length):
+                segment = tour[i:i+length]
+                a, b = tour[i-1], tour[i+length]
+                removal = D[a][segment[0]] + D[segment[-1]][b] - D[a][b]
+                rest = tour[:i] + tour[i+length:]
+                for p in range(len(rest)-1):
+                    if p == i-1: continue
+                    u, v = rest[p], rest[p+1]
+                    if D[u][segment[0]] + D[segment[-1]][v] - D[u][v] < removal:
+                        tour = rest[:p+1] + segment + rest[p+1:]
+                        improved = True
+                        break
+                if improved: break
+            if improved: break
+
+    return tour[1:-1]
+
+def reoptimize_route(route, D_values, n, cache=None, digest=None):
+    """Re-sequence the items of a single courier route.
+
+    Args:
+        route (list): items (0-based) of the route in visiting order
+        D_values (list): distance matrix
+        n (int): number of items (the origin point is the index n)
+        cache (RouteCache): cache of the item sets already solved exactly
+        digest (str): identifier of the distance matrix for the cache
+
+    Returns:
+        list: items in the new visiting order (never longer than the given one)
+    """
+
+    if len(route) <= 1: return list(route)
+
+    if len(route) <= EXACT_LIMIT:
+        cached = cache.get(digest, route) if cache is not None else None
+        if cached is not None: return cached
+        new_route = held_karp(route, D_values, n)
+        if cache is not None: cache.put(digest, route, new_route)
+    else:
+        new_route = local_search(route, D_values, n)
+
+    if route_length(new_route, D_values, n) < route_length(route, D_values, n): return new_route
+    return list(route)
+
+def reoptimize_results(results, D_values, cache=None):
+    """Optional final stage of the runners: re-sequence every route of a solution (sol) and update
+    its objective (obj) when the longest route gets shorter. Proven optimal results are not touched.
+
+    Args:
+        results (dict): results of a model with the keys time, optimal, obj and sol
+        D_values (list): distance matrix
+        cache (RouteCache): cache of the item sets already solved exactly
+
+    Returns:
+        dict: the updated results
+    """
+
+    if results.get("optimal") or not results.get("sol"): return results
+
+    n = len(D_values) - 1
+    digest = distances_digest(D_values)
+    routes = [reoptimize_route([i-1 for i in route], D_values, n, cache, digest) for route in results["sol"]]
+    obj = max([route_length(route, D_values, n) for route in routes])
+
+    if results.get("obj") is None or obj < results["obj"]:
+        results["obj"] = obj
+        results["sol"] = [[i+1 for i in route] for route in routes]
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # Re-optimize the results already written, e.g. python reoptimize.py res/MIP/
+    res_folder = sys.argv[1] if len(sys.argv) > 1 else 'res/MIP/'
+    data_folder = 'data/'
+
+    cache = RouteCache()
+    for res_file in sorted(os.listdir(res_folder)):
+        if not res_file.endswith('.json'): continue
+
+        with open(f"{data_folder}inst{res_file[:2]}.dat", "r") as file:
+            D_values = [list(map(int, line.split())) for line in file.readlines()[4:] if line.strip()]
+
+        with open(os.path.join(res_folder, res_file), 'r') as file:
+            data = json.load(file)
+
+        for model_name in data:
+            reoptimize_results(data[model_name], D_values, cache)
+
+        with open(os.path.join(res_folder, res_file), 'w') as file:
+            json.dump(data, file, indent=4)
+
+    cache.save()
@@ -0,0 +1,481 @@
+import os
+import sys
+import json
+import heapq
+import argparse
+import threading
+import itertools
+import multiprocessing
+from collections import OrderedDict
+from time import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from reoptimize import reoptimize_results, route_length
+from deadline import Deadline, DeadlineExceeded
+from incremental import apply_delta, repair_solution, initial_solution, instance_key
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Folder of the modules of each approach (imported once by every worker when it starts)
+BACKENDS = {
+    "MIP": os.path.join(ROOT, "MIP"),
+    "SMT": os.path.join(ROOT, "SMT"),
+    "CP": os.path.join(ROOT, "CP", "src"),
+    "DEC": os.path.join(ROOT, "DEC"),
+}
+
+# Models each backend can solve, the first one is the default (CP models are named {model}_{solver})
+MODELS = {
+    "MIP": ["MCPLazy", "MCP", "MCPSymbreakImp", "MCPGranular"],
+    "SMT": ["MCPSymbreakImp", "MCP", "MCPGranular"],
+    "CP": [f"{model}_{solver}" for model in ("MCPSymbreakImp", "MCP", "MCPGranular") for solver in ("gecode", "chuffed")],
+    "DEC": ["MCPDecomposition"],
+}
+
+# Models used to re-solve an instance after a small change (starting from the repaired solution)
+RESOLVE_MODELS = {
+    "MIP": ["MCPLazy", "MCPGranular"],
+    "SMT": ["MCP", "MCPSymbreakImp"],
+    "CP": [f"{model}_{solver}" for model in ("MCP", "MCPSymbreakImp") for solver in ("gecode", "chuffed")],
+    "DEC": ["MCPDecomposition"],
+}
+
+DEFAULT_TIMEOUT = 300
+MAX_SESSIONS = 8            # Live solvers kept by every worker for incremental re-solves
+LATENCY_WINDOW = 1000       # Number of finished jobs used for the latency metrics
+JOB_RETENTION = 3600        # Seconds a finished job (and its instance) is kept for /jobs/<id>
+WAIT_MARGIN = 60            # Extra seconds (over the job timeout) a "wait" request is held before replying 202
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# WORKERS (one process per worker, the backend stays imported between jobs)
+
+def solve_mip(module, model_name, parameters, deadline):
+    if model_name in ("MCPLazy", "MCPGranular"):
+        # Start from a heuristic solution, so the subtour loop always has an incumbent
+        return module.solve_warm_model(model_name, parameters, initial_solution(parameters), deadline)
+    model, routes = module.build_model(model_name, parameters, deadline)
+    return module.solve_model(model, routes, parameters, deadline=deadline)
+
+def solve_smt(module, model_name, parameters, deadline):
+    if model_name == "MCPGranular":
+        return module.solve_granular_model(parameters, model_name, deadline=deadline)[model_name]
+    solver, routes, maximum = module.build_model(parameters, model_name, deadline=deadline)
+    return module.solve_model(solver, routes, maximum, parameters, model_name, deadline)[model_name]
+
+def solve_cp(module, model_name, parameters, deadline):
+    # CP models are named {model}_{solver} as in the CP results
+    model_file, solver_name = model_name.rsplit("_", 1)
+
+    if model_file == "MCPGranular":
+        result = module.asyncio.run(module.solve_granular(solver_name, None, parameters=parameters, deadline=deadline))
+    else:
+        instance = module.Instance(module.Solver.lookup(solver_name), module.Model(f"CP/src/{model_file}.mzn"))
+        module.set_parameters(instance, parameters)
+        result = instance.solve(timeout=module.timedelta(seconds=deadline.remaining()))
+
+    return module.result_to_dict(result, deadline)
+
+def solve_dec(module, model_name, parameters, deadline):
+    return module.solve_decomposition(parameters, deadline=deadline)
+
+def resolve_mip(module, model_name, parameters, routes, deadline, sessions):
+    # CBC MIP start from the repaired routes
+    return module.solve_warm_model(model_name, parameters, routes, deadline)
+
+def resolve_smt(module, model_name, parameters, routes, deadline, sessions):
+    # The z3 solver of the instance is kept alive, only the loads change between solves
+    key = (instance_key(parameters), model_name)
+    if key not in sessions: sessions[key] = module.build_incremental_model(parameters, model_name, deadline)
+    sessions.move_to_end(key)
+    return module.solve_incremental_model(sessions[key], parameters[2], routes, model_name, deadline)[model_name]
+
+def resolve_cp(module, model_name, parameters, routes, deadline, sessions):
+    # The minizinc instance is kept alive, every solve is a branch with its own loads
+    model_file, solver_name = model_name.rsplit("_", 1)
+    key = (instance_key(parameters), model_name)
+    if key not in sessions: sessions[key] = module.build_incremental_instance(solver_name, parameters, model_file)
+    sessions.move_to_end(key)
+    return module.solve_incremental(sessions[key], parameters, routes, deadline)
+
+def resolve_dec(module, model_name, parameters, routes, deadline, sessions):
+    # No model to warm start, the repaired solution (re-sequenced afterwards) is the answer
+    return repaired_results(parameters, routes, deadline)
+
+def repaired_results(parameters, routes, deadline):
+    """Results of a repaired solution (feasible, never proven optimal)"""
+    obj = max([route_length(route, parameters[4], parameters[1]) for route in routes])
+    return {"time": deadline.budget, "optimal": False, "obj": obj, "sol": [[i+1 for i in route] for route in routes]}
+
+RESOLVERS = {
+    "MIP": resolve_mip,
+    "SMT": resolve_smt,
+    "CP": resolve_cp,
+    "DEC": resolve_dec,
+}
+
+SOLVERS = {
+    "MIP": ("models", solve_mip),
+    "SMT": ("models", solve_smt),
+    "CP": ("solve_cp", solve_cp),
+    "DEC": ("models", solve_dec),
+}
+
+def worker_main(backend, conn):
+    """Entry point of a worker process: import the backend once, then solve the jobs received through
+    the pipe until None is received.
+
+    Args:
+        backend (str): approach solved by the worker (MIP, SMT, CP or DEC)
+        conn (multiprocessing.Connection): pipe to the scheduler thread of the worker
+    """
+
+    # The backends use paths relative to the repository and their own models/utils modules
+    os.chdir(ROOT)
+    sys.path.insert(0, BACKENDS[backend])
+    module_name, solve = SOLVERS[backend]
+    module = __import__(module_name)
+    sessions = OrderedDict()
+    conn.send("ready")
+
+    while True:
+        job = conn.recv()
+        if job is None: break
+
+        # The time budget of the job starts when the worker receives it
+        deadline = Deadline(job["timeout"])
+        try:
+            parameters = (job["m"], job["n"], job["l"], job["s"], job["D"])
+            routes = None
+            try:
+                # Incremental re-solve from the repaired previous solution (cold solve if it cannot be repaired)
+                routes = repair_solution(parameters, job["previous_sol"], job["mapping"]) if "previous_sol" in job else None
+                if routes is not None:
+                    results = RESOLVERS[backend](module, job["model"], parameters, routes, deadline, sessions)
+                    while len(sessions) > MAX_SESSIONS: sessions.popitem(last=False)
+                else:
+                    results = solve(module, job["model"], parameters, deadline)
+            except DeadlineExceeded:
+                # Out of time while building the model: the repaired solution (if any) is still feasible
+                if routes is not None: results = repaired_results(parameters, routes, deadline)
+                else: results = {"time": deadline.budget, "optimal": False, "obj": None, "sol": []}
+            if job["post_optimize"]: reoptimize_results(results, job["D"])
+            conn.send(("done", results))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# SCHEDULER
+
+class Scheduler:
+    """Priority queues of jobs (one per backend) served by a pool of warm worker processes. Every
+    worker is driven by a thread of the server process that hands it the next job of its queue.
+    """
+
+    def __init__(self, workers):
+        self.condition = threading.Condition()
+        self.queues = {backend: [] for backend in BACKENDS}
+        self.jobs = {}
+        self.finished = []
+        self.counter = itertools.count()
+        self.busy = {backend: 0 for backend in BACKENDS}
+        # Workers still importing their backend and workers ready to solve
+        self.starting = {backend: workers.get(backend, 0) for backend in BACKENDS}
+        self.alive = {backend: 0 for backend in BACKENDS}
+        self.processes = []
+
+        context = multiprocessing.get_context("spawn")
+        for backend, number in workers.items():
+            for _ in range(number):
+                parent, child = context.Pipe()
+                process = context.Process(target=worker_main, args=(backend, child))
+                process.start()
+                child.close()
+                self.processes.append((process, parent))
+                threading.Thread(target=self.dispatch, args=(backend, parent), daemon=True).start()
+        self.workers = workers
+
+    def available(self, backend):
+        """Number of workers of a backend that are alive or still starting"""
+        return self.starting[backend] + self.alive[backend]
+
+    def submit(self, job):
+        """Queue a job
+
+        Raises:
+            ValueError: if no worker of the backend of the job is alive
+        """
+        with self.condition:
+            if self.available(job["approach"]) == 0:
+                raise ValueError(f"no live workers for the approach {job['approach']}")
+            job["id"] = f"{next(self.counter):08d}"
+            job["status"] = "queued"
+            job["submitted"] = time()
+            job["event"] = threading.Event()
+            # Higher priority first, then first come first served
+            heapq.heappush(self.queues[job["approach"]], (-job["priority"], job["id"]))
+            self.jobs[job["id"]] = job
+            self.evict()
+            self.condition.notify_all()
+        return job
+
+    def evict(self):
+        """Forget the jobs finished more than JOB_RETENTION seconds ago (call it holding the condition)"""
+        limit = time() - JOB_RETENTION
+        expired = [job_id for job_id, job in self.jobs.items() if job.get("finished", limit) < limit]
+        for job_id in expired: del self.jobs[job_id]
+
+    def dispatch(self, backend, conn):
+        # Wait until the worker has imported its backend
+        try:
+            conn.recv()
+        except EOFError:
+            print(f"A {backend} worker could not start (is the backend installed?)")
+            with self.condition:
+                self.starting[backend] -= 1
+                self.worker_lost(backend)
+            return
+
+        with self.condition:
+            self.starting[backend] -= 1
+            self.alive[backend] += 1
+
+        while True:
+            with self.condition:
+                while not self.queues[backend]:
+                    self.condition.wait()
+                _, job_id = heapq.heappop(self.queues[backend])
+                job = self.jobs[job_id]
+                job["status"] = "running"
+                job["started"] = time()
+                self.busy[backend] += 1
+
+            conn.send({key: job[key] for key in ("m", "n", "l", "s", "D", "model", "timeout", "post_optimize",
+                                                 "previous_sol", "mapping") if key in job})
+            try:
+                status, value = conn.recv()
+            except EOFError:
+                status, value = "error", "worker process died"
+
+            with self.condition:
+                job["finished"] = time()
+                job["status"] = status
+                job["result" if status == "done" else "error"] = value
+                self.busy[backend] -= 1
+                self.finished.append((job["submitted"], job["started"], job["finished"]))
+                self.finished = self.finished[-LATENCY_WINDOW:]
+            job["event"].set()
+
+            if status == "error" and value == "worker process died":
+                print(f"A {backend} worker died")
+                with self.condition:
+                    self.alive[backend] -= 1
+                    self.worker_lost(backend)
+                break
+
+    def worker_lost(self, backend):
+        """Fail the queued jobs of a backend left without workers (call it holding the condition)"""
+        if self.available(backend) > 0: return
+
+        while self.queues[backend]:
+            _, job_id = heapq.heappop(self.queues[backend])
+            job = self.jobs[job_id]
+            job["finished"] = time()
+            job["status"] = "error"
+            job["error"] = f"no live workers for the approach {backend}"
+            job["event"].set()
+
+    def metrics(self):
+        with self.condition:
+            queue_depth = {backend: len(queue) for backend, queue in self.queues.items()}
+            finished = list(self.finished)
+            busy = dict(self.busy)
+            starting = dict(self.starting)
+            alive = dict(self.alive)
+
+        def summary(values):
+            if not values: return None
+            values = sorted(values)
+            return {
+                "mean": sum(values) / len(values),
+                "p50": values[len(values) // 2],
+                "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+                "max": values[-1]
+            }
+
+        return {
+            "queue_depth": queue_depth,
+            "workers": {backend: {"total": self.workers.get(backend, 0), "starting": starting[backend],
+                                  "alive": alive[backend], "busy": busy[backend]} for backend in BACKENDS},
+            "finished": len(finished),
+            "latency": {
+                "queue": summary([started - submitted for submitted, started, _ in finished]),
+                "solve": summary([end - started for _, started, end in finished]),
+                "total": summary([end - submitted for submitted, _, end in finished])
+            }
+        }
+
+    def shutdown(self):
+        for process, conn in self.processes:
+            if process.is_alive(): process.terminate()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# HTTP API
+
+def parse_job(payload, workers):
+    """Validate a solve request and fill the default values
+
+    Args:
+        payload (dict): body of the request
+        workers (dict): number of workers of each backend
+
+    Returns:
+        dict: the job to be queued
+
+    Raises:
+        ValueError: if the request is not valid
+    """
+
+    job = {key: payload.get(key) for key in ("m", "n", "l", "s", "D")}
+    if None in job.values(): raise ValueError("the instance needs m, n, l, s and D")
+
+    m, n, l, s, D = job.values()
+    if len(l) != m or len(s) != n or len(D) != n+1 or any(len(row) != n+1 for row in D):
+        raise ValueError("the sizes of l, s and D do not match m and n")
+
+    job["approach"] = payload.get("approach", "MIP")
+    if workers.get(job["approach"], 0) == 0: raise ValueError(f"no workers for the approach {job['approach']}")
+
+    job["model"] = parse_model(payload, MODELS[job["approach"]])
+    job["timeout"] = payload.get("timeout", DEFAULT_TIMEOUT)
+    job["priority"] = payload.get("priority", 0)
+    for key in ("timeout", "priority"):
+        if isinstance(job[key], bool) or not isinstance(job[key], (int, float)): raise ValueError(f"{key} must be a number")
+    if job["timeout"] <= 0: raise ValueError("timeout must be positive")
+    job["post_optimize"] = payload.get("post_optimize", True)
+
+    return job
+
+def parse_resolve_job(payload, workers):
+    """Validate an incremental re-solve request: the previous instance (m, n, l, s, D), its solution
+    (sol) and the change (delta, see incremental.apply_delta). The job solves the new instance.
+
+    Args:
+        payload (dict): body of the request
+        workers (dict): number of workers of each backend
+
+    Returns:
+        dict: the job to be queued
+
+    Raises:
+        ValueError: if the request is not valid
+    """
+
+    previous = parse_job(payload, workers)
+    if "sol" not in payload or "delta" not in payload: raise ValueError("a re-solve needs sol and delta")
+
+    # The solution of the previous instance: at most m routes, every item of 1..n at most once
+    sol = payload["sol"]
+    if not isinstance(sol, list) or len(sol) > previous["m"] or any(not isinstance(route, list) for route in sol):
+        raise ValueError("sol must be a list of at most m routes")
+    items = [item for route in sol for item in route]
+    if any(isinstance(item, bool) or not isinstance(item, int) or not 1 <= item <= previous["n"] for item in items):
+        raise ValueError("the items of sol must be in 1..n")
+    if len(set(items)) != len(items): raise ValueError("every item must appear at most once in sol")
+
+    parameters, mapping = apply_delta(tuple(previous[key] for key in ("m", "n", "l", "s", "D")), payload["delta"])
+
+    job = dict(previous)
+    job.update(zip(("m", "n", "l", "s", "D"), parameters))
+    job["model"] = parse_model(payload, RESOLVE_MODELS[job["approach"]])
+    job["previous_sol"] = payload["sol"]
+    job["mapping"] = mapping
+
+    return job
+
+def parse_model(payload, models):
+    """Model of a request, checked against the models allowed for its approach (the first one by default)
+
+    Raises:
+        ValueError: if the model is not allowed
+    """
+    model = payload.get("model", models[0])
+    if model not in models: raise ValueError(f"model must be one of {', '.join(models)}")
+    return model
+
+def job_view(job):
+    view = {key: job[key] for key in ("id", "status", "approach", "model", "priority") if key in job}
+    if job["status"] == "done": view["result"] = {job["model"]: job["result"]}
+    if job["status"] == "error": view["error"] = job["error"]
+    return view
+
+class Handler(BaseHTTPRequestHandler):
+    """POST /solve queues an instance (add "wait": true to get the results in the response),
+    POST /resolve queues a changed instance warm started from a previous solution,
+    GET /jobs/<id> returns the status and results of a job, GET /metrics the service metrics.
+    """
+
+    scheduler = None
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        parsers = {"/solve": parse_job, "/resolve": parse_resolve_job}
+        if self.path not in parsers: return self.reply(404, {"error": "not found"})
+
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job = parsers[self.path](payload, self.scheduler.workers)
+            job = self.scheduler.submit(job)
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.reply(400, {"error": str(e)})
+
+        if not payload.get("wait", False): return self.reply(202, job_view(job))
+
+        # Do not hold the connection forever: if the job is not done in time, the client polls /jobs/<id>
+        if not job["event"].wait(timeout=job["timeout"] + WAIT_MARGIN): return self.reply(202, job_view(job))
+        self.reply(200, job_view(job))
+
+    def do_GET(self):
+        if self.path == "/metrics": return self.reply(200, self.scheduler.metrics())
+
+        if self.path.startswith("/jobs/"):
+            job = self.scheduler.jobs.get(self.path[len("/jobs/"):])
+            if job is None: return self.reply(404, {"error": "unknown job"})
+            return self.reply(200, job_view(job))
+
+        self.reply(404, {"error": "not found"})
+
+
+if __name__ == "__main__":
+
+    # e.g. python service.py --port 8765 --workers MIP=2 SMT=1 CP=1 DEC=1
+    parser = argparse.ArgumentParser(description="Local MCP solve service with warm worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", nargs="*", default=["MIP=1", "SMT=1", "CP=1", "DEC=1"],
+                        help="number of workers of each backend, as BACKEND=NUMBER")
+    args = parser.parse_args()
+
+    workers = {backend: int(number) for backend, number in (option.split("=") for option in args.workers)}
+    unknown = set(workers) - set(BACKENDS)
+    if unknown: parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+
+    Handler.scheduler = Scheduler(workers)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Handler.scheduler.shutdown()